@@ -1,7 +1,8 @@
 """Support for D-Link motion sensors."""
 import asyncio
 import logging
-from datetime import timedelta, datetime
+from datetime import timedelta
+from time import monotonic, time
 
 import voluptuous as vol
 
@@ -21,6 +22,9 @@ from homeassistant.const import (
 )
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.debounce import Debouncer
+from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.helpers.storage import Store
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -28,8 +32,20 @@ DEFAULT_NAME = "D-Link Motion Sensor"
 DEFAULT_USERNAME = "Admin"
 DEFAULT_TIMEOUT = 35
 
+STORAGE_VERSION = 1
+MODULE_ID = 1
+
+DATA_CLIENTS = "dlink_hnap_clients"
+
 SCAN_INTERVAL = timedelta(seconds=5)
 
+# Motion polling backs off when nothing has happened for a while and
+# speeds up for a minute after every state change
+IDLE_SCAN_INTERVAL = timedelta(seconds=30)
+ACTIVE_SCAN_INTERVAL = timedelta(seconds=2)
+ACTIVE_PERIOD = 60
+DEBOUNCE_COOLDOWN = 1.0
+
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
     {
         vol.Required(CONF_HOST): cv.string,
@@ -52,23 +68,64 @@ async def async_setup_platform(hass, config, async_add_devices, discovery_info=N
         ACTION_BASE_URL,
     )
 
-    soap = NanoSOAPClient(
-        config.get(CONF_HOST),
-        ACTION_BASE_URL,
-        loop=hass.loop,
-        session=async_get_clientsession(hass),
-    )
+    # Share one client per device so motion and water sensors on the
+    # same device reuse the login session and auth token cache
+    clients = hass.data.setdefault(DATA_CLIENTS, {})
+    client_key = (config.get(CONF_HOST), config.get(CONF_USERNAME))
+    client = clients.get(client_key)
+    if client is None:
+        soap = NanoSOAPClient(
+            config.get(CONF_HOST),
+            ACTION_BASE_URL,
+            loop=hass.loop,
+            session=async_get_clientsession(hass),
+        )
+
+        client = HNAPClient(
+            soap, config.get(CONF_USERNAME), config.get(CONF_PASSWORD), loop=hass.loop
+        )
+        clients[client_key] = client
 
-    client = HNAPClient(
-        soap, config.get(CONF_USERNAME), config.get(CONF_PASSWORD), loop=hass.loop
+    # One store per platform entry so a failure on one sensor type
+    # cannot wipe the cache of another on the same host
+    store = Store(
+        hass,
+        STORAGE_VERSION,
+        "dlink_hnap_{0}_{1}".format(config.get(CONF_HOST), config.get(CONF_TYPE)),
     )
 
+    # Device data never changes, so restore it from the store or fetch
+    # it once here instead of on every cold first poll
+    data = await store.async_load()
+    soap_actions = None
+    if data:
+        soap_actions = data.get("soap_actions")
+        if data.get("device_actions"):
+            client.actions = data["device_actions"]
+    else:
+        try:
+            await client.login()
+            resp = await client.soap_actions(MODULE_ID)
+            soap_actions = resp["ModuleSOAPList"]["SOAPActions"]["Action"]
+        except Exception:
+            _LOGGER.warning(
+                "Failed to fetch device data during setup, deferring to first update"
+            )
+
     if config.get(CONF_TYPE) == "motion":
         sensor = DlinkMotionSensor(
-            config.get(CONF_NAME), config.get(CONF_TIMEOUT), MotionSensor(client)
+            config.get(CONF_NAME),
+            config.get(CONF_TIMEOUT),
+            MotionSensor(client, soap_actions=soap_actions),
+            store,
         )
     else:
-        sensor = DlinkWaterSensor(config.get(CONF_NAME), WaterSensor(client))
+        sensor = DlinkWaterSensor(
+            config.get(CONF_NAME), WaterSensor(client, soap_actions=soap_actions), store
+        )
+
+    # Data restored from the store does not need saving again
+    sensor._stored = bool(data)
 
     async_add_devices([sensor], update_before_add=True)
 
@@ -76,13 +133,32 @@ async def async_setup_platform(hass, config, async_add_devices, discovery_info=N
 class DlinkBinarySensor(BinarySensorEntity):
     """Representation of a D-Link binary sensor."""
 
-    def __init__(self, name, sensor, device_class):
+    def __init__(self, name, sensor, device_class, store=None):
         """Initialize the D-Link motion binary sensor."""
         self._name = name
         self._sensor = sensor
         self._device_class = device_class
+        self._store = store
+        self._stored = False
         self._on = False
 
+    async def _async_save_device_data(self):
+        """Save device data so the next restart can skip fetching it."""
+        if not self._store or self._stored:
+            return
+
+        data = self._sensor.cached_data()
+        if data:
+            self._stored = True
+            await self._store.async_save(data)
+
+    async def _async_invalidate_device_data(self):
+        """Drop cached device data after a bad response."""
+        self._sensor.invalidate_cached_data()
+        if self._store and self._stored:
+            self._stored = False
+            await self._store.async_save({})
+
     @property
     def name(self):
         """Return the name of the binary sensor."""
@@ -102,10 +178,74 @@ class DlinkBinarySensor(BinarySensorEntity):
 class DlinkMotionSensor(DlinkBinarySensor):
     """Representation of a D-Link motion sensor."""
 
-    def __init__(self, name, timeout, sensor):
+    def __init__(self, name, timeout, sensor, store=None):
         """Initialize the D-Link motion binary sensor."""
-        super().__init__(name, sensor, DEVICE_CLASS_MOTION)
+        super().__init__(name, sensor, DEVICE_CLASS_MOTION, store)
         self._timeout = timeout
+        self._debouncer = None
+        self._interval = None
+        self._unsub_poll = None
+        self._removed = False
+        # Start at the normal cadence instead of treating startup as a
+        # fresh state change
+        self._last_change = monotonic() - ACTIVE_PERIOD
+
+    @property
+    def should_poll(self):
+        """Return False as the sensor schedules its own polling."""
+        return False
+
+    async def async_added_to_hass(self):
+        """Start polling with a debouncer when added to hass."""
+        await super().async_added_to_hass()
+        self._debouncer = Debouncer(
+            self.hass,
+            _LOGGER,
+            cooldown=DEBOUNCE_COOLDOWN,
+            immediate=True,
+            function=self._async_poll,
+        )
+        self._schedule_poll(SCAN_INTERVAL)
+
+    async def async_will_remove_from_hass(self):
+        """Stop polling when removed from hass."""
+        self._removed = True
+        if self._unsub_poll:
+            self._unsub_poll()
+            self._unsub_poll = None
+
+    def _schedule_poll(self, interval):
+        """(Re-)register the poll timer if the interval changed."""
+        if self._unsub_poll:
+            if interval == self._interval:
+                return
+            self._unsub_poll()
+
+        self._interval = interval
+        self._unsub_poll = async_track_time_interval(
+            self.hass, self._async_trigger_poll, interval
+        )
+
+    async def _async_trigger_poll(self, now=None):
+        """Coalesce poll triggers through the debouncer."""
+        await self._debouncer.async_call()
+
+    async def _async_poll(self):
+        """Poll the device and adapt the poll interval to activity."""
+        # A cooldown call may still fire after removal
+        if self._removed:
+            return
+
+        await self.async_update()
+
+        idle_for = monotonic() - self._last_change
+        if idle_for < ACTIVE_PERIOD:
+            interval = ACTIVE_SCAN_INTERVAL
+        elif idle_for > self._timeout * 2:
+            interval = IDLE_SCAN_INTERVAL
+        else:
+            interval = SCAN_INTERVAL
+        self._schedule_poll(interval)
 
     async def async_update(self):
         """Get the latest data and updates the states."""
@@ -114,36 +254,39 @@ class DlinkMotionSensor(DlinkBinarySensor):
         except Exception:
             last_trigger = None
             _LOGGER.exception("failed to update motion sensor")
+            await self._async_invalidate_device_data()
 
         if not last_trigger:
             return
 
-        has_timed_out = datetime.now() > last_trigger + timedelta(seconds=self._timeout)
-        if has_timed_out:
-            if self._on:
-                self._on = False
-                self.hass.async_add_job(self.async_update_ha_state(True))
-        else:
-            if not self._on:
-                self._on = True
-                self.hass.async_add_job(self.async_update_ha_state(True))
+        await self._async_save_device_data()
+
+        new_state = time() <= last_trigger + self._timeout
+        if new_state == self._on:
+            return
+
+        self._on = new_state
+        self._last_change = monotonic()
+        # No entity_id yet during the update before add; the add itself
+        # writes the initial state
+        if self.entity_id:
+            self.async_write_ha_state()
 
 
 class DlinkWaterSensor(DlinkBinarySensor):
     """Representation of a D-Link water sensor."""
 
-    def __init__(self, name, sensor):
+    def __init__(self, name, sensor, store=None):
         """Initialize the D-Link motion binary sensor."""
-        super().__init__(name, sensor, DEVICE_CLASS_MOISTURE)
+        super().__init__(name, sensor, DEVICE_CLASS_MOISTURE, store)
 
     async def async_update(self):
         """Get the latest data and updates the states."""
         try:
             water_detected = await self._sensor.water_detected()
-            if self._on != water_detected:
-                self._on = water_detected
-                self.hass.async_add_job(self.async_update_ha_state(True))
+            await self._async_save_device_data()
+            self._on = water_detected
 
         except Exception:
-            last_trigger = None
             _LOGGER.exception("failed to update water sensor")
+            await self._async_invalidate_device_data()
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 """Read data from D-Link motion sensor."""
 
-import xml
 import hmac
+import time
 import urllib
 import logging
 import asyncio
@@ -12,20 +12,42 @@ import xml.etree.ElementTree as ET
 
 from io import BytesIO
 from datetime import datetime
-
-import xmltodict
+from xml.sax.saxutils import escape
 
 _LOGGER = logging.getLogger(__name__)
 
 ACTION_BASE_URL = "http://purenetworks.com/HNAP1/"
 
+CALL_TIMEOUT = 3
+RETRY_ATTEMPTS = 3
+RETRY_DELAY = 0.2
+
+
+def _element_to_dict(element):
+    """Convert a response element into nested dicts, lists and strings."""
+    if len(element) == 0:
+        return element.text
+
+    result = {}
+    for child in element:
+        tag = child.tag.rpartition("}")[2]
+        value = _element_to_dict(child)
+        if tag in result:
+            if not isinstance(result[tag], list):
+                result[tag] = [result[tag]]
+            result[tag].append(value)
+        else:
+            result[tag] = value
+    return result
+
 
 def _hmac(key, message):
-    return (
-        hmac.new(key.encode("utf-8"), message.encode("utf-8"), digestmod="MD5")
-        .hexdigest()
-        .upper()
-    )
+    """Compute an HNAP digest over already encoded bytes.
+
+    The digests are tiny, so this intentionally runs on the event loop;
+    pushing them to an executor would cost more than the hash itself.
+    """
+    return hmac.new(key, message, digestmod="MD5").hexdigest().upper()
 
 
 class AuthenticationError(Exception):
@@ -46,15 +68,22 @@ class HNAPClient:
         self.actions = None
         self._client = soap
         self._private_key = None
+        self._hmac_proto = None
         self._cookie = None
         self._auth_token = None
         self._timestamp = None
+        self._token_cache = {}
+        self._request_lock = asyncio.Lock()
 
     async def login(self):
         """Authenticate with device and obtain cookie."""
+        async with self._request_lock:
+            await self._login()
+
+    async def _login(self):
         _LOGGER.info("Logging into device")
         self.logged_in = False
-        resp = await self.call(
+        resp = await self._call(
             "Login",
             Action="request",
             Username=self.username,
@@ -72,12 +101,18 @@ class HNAPClient:
             self._cookie,
         )
 
-        self._private_key = _hmac(public_key + str(self.password), challenge)
+        # Encode the challenge once and reuse it for both digests
+        challenge_enc = challenge.encode("utf-8")
+        self._private_key = _hmac(
+            (public_key + str(self.password)).encode("utf-8"), challenge_enc
+        )
+        self._hmac_proto = hmac.new(self._private_key.encode("utf-8"), digestmod="MD5")
+        self._token_cache.clear()
         _LOGGER.debug("Private key: %s", self._private_key)
 
         try:
-            password = _hmac(self._private_key, challenge)
-            resp = await self.call(
+            password = _hmac(self._private_key.encode("utf-8"), challenge_enc)
+            resp = await self._call(
                 "Login",
                 Action="login",
                 Username=self.username,
@@ -91,13 +126,13 @@ class HNAPClient:
             if not self.actions:
                 self.actions = await self.device_actions()
 
-        except xml.parsers.expat.ExpatError:
+        except ET.ParseError:
             raise AuthenticationError("Bad response from device")
 
         self.logged_in = True
 
     async def device_actions(self):
-        actions = await self.call("GetDeviceSettings")
+        actions = await self._call("GetDeviceSettings")
         return list(
             map(lambda x: x[x.rfind("/") + 1 :], actions["SOAPActions"]["string"])
         )
@@ -107,22 +142,40 @@ class HNAPClient:
 
     async def call(self, method, *args, **kwargs):
         """Call an NHAP method (async)."""
+        # Serialize calls so concurrent sensors cannot clash on the
+        # auth token or race each other into re-login
+        async with self._request_lock:
+            return await self._call(method, *args, **kwargs)
+
+    async def _call(self, method, *args, **kwargs):
         # Do login if no login has been done before
         if not self._private_key and method != "Login":
-            await self.login()
-
-        self._update_nauth_token(method)
-        try:
-            result = await self.soap().call(method, **kwargs)
-            if "ERROR" in result:
+            await self._login()
+
+        for attempt in range(RETRY_ATTEMPTS):
+            self._update_nauth_token(method)
+            try:
+                result = await asyncio.wait_for(
+                    self.soap().call(method, **kwargs), CALL_TIMEOUT
+                )
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                # Transient network problem: back off and retry
+                if attempt + 1 == RETRY_ATTEMPTS:
+                    self._bad_response()
+                delay = RETRY_DELAY * 2 ** attempt
+                _LOGGER.debug("Retrying %s in %.1f second(s)", method, delay)
+                await asyncio.sleep(delay)
+            except Exception:
                 self._bad_response()
-        except:
-            self._bad_response()
-        return result
+            else:
+                if "ERROR" in result:
+                    self._bad_response()
+                return result
 
     def _bad_response(self):
         _LOGGER.error("Got an error, resetting private key")
         self._private_key = None
+        self._hmac_proto = None
         raise Exception("got error response from device")
 
     def _update_nauth_token(self, action):
@@ -130,17 +183,28 @@ class HNAPClient:
         if not self._private_key:
             return
 
-        self._timestamp = int(datetime.now().timestamp())
-        self._auth_token = _hmac(
-            self._private_key,
-            '{0}"{1}{2}"'.format(self._timestamp, ACTION_BASE_URL, action),
-        )
-        _LOGGER.debug(
-            "Generated new token for %s: %s (time: %d)",
-            action,
-            self._auth_token,
-            self._timestamp,
-        )
+        timestamp = int(time.time())
+        token = self._token_cache.get((timestamp, action))
+        if token is None:
+            # Reuse the keyed HMAC state from login instead of
+            # rebuilding it for every token
+            digest = self._hmac_proto.copy()
+            digest.update(
+                '{0}"{1}{2}"'.format(timestamp, ACTION_BASE_URL, action).encode("utf-8")
+            )
+            token = digest.hexdigest().upper()
+            if len(self._token_cache) > 16:
+                self._token_cache.clear()
+            self._token_cache[(timestamp, action)] = token
+            _LOGGER.debug(
+                "Generated new token for %s: %s (time: %d)",
+                action,
+                token,
+                timestamp,
+            )
+
+        self._timestamp = timestamp
+        self._auth_token = token
 
     def soap(self):
         """Get SOAP client with updated headers."""
@@ -157,14 +221,14 @@ class HNAPClient:
 class BaseSensor:
     """Wrapper class for a sensor."""
 
-    def __init__(self, client, module_id=1):
+    def __init__(self, client, module_id=1, soap_actions=None):
         """Initialize a new BaseSensor instance."""
         self.client = client
         self.module_id = module_id
-        self._soap_actions = None
+        self._soap_actions = soap_actions
 
     async def latest_trigger(self):
-        """Get latest trigger time from sensor."""
+        """Get latest trigger time (epoch seconds) from sensor."""
         if not self._soap_actions:
             await self._cache_soap_actions()
 
@@ -173,25 +237,37 @@ class BaseSensor:
             resp = await self.client.call("GetLatestDetection", ModuleID=self.module_id)
             detect_time = resp["LatestDetectTime"]
         else:
-            resp = await self.client.call(
+            # Only the first timestamp matters, so skip parsing the
+            # rest of the log list
+            detect_time = await self.client.call(
                 "GetMotionDetectorLogs",
+                extract="TimeStamp",
                 ModuleID=self.module_id,
                 MaxCount=1,
                 PageOffset=1,
                 StartTime=0,
                 EndTime="All",
             )
-            if "MotionDetectorLogList" not in resp:
-                _LOGGER.error("log list: " + str(resp))
-            log_list = resp["MotionDetectorLogList"]
-            detect_time = log_list["MotionDetectorLog"]["TimeStamp"]
 
-        return datetime.fromtimestamp(float(detect_time))
+        return float(detect_time)
 
     async def _cache_soap_actions(self):
         resp = await self.client.soap_actions(self.module_id)
         self._soap_actions = resp["ModuleSOAPList"]["SOAPActions"]["Action"]
 
+    def cached_data(self):
+        """Return device data worth caching between sessions."""
+        if not self._soap_actions:
+            return None
+        return {
+            "soap_actions": self._soap_actions,
+            "device_actions": self.client.actions,
+        }
+
+    def invalidate_cached_data(self):
+        """Forget cached device data after a bad response."""
+        self._soap_actions = None
+
 
 class MotionSensor(BaseSensor):
     """Wrapper class for motion sensor."""
@@ -203,9 +279,16 @@ class WaterSensor(BaseSensor):
     async def water_detected(self):
         """Get latest trigger time from sensor."""
         if not self._soap_actions:
-            await self._cache_soap_actions()
-
-        resp = await self.client.call("GetWaterDetectorState", ModuleID=self.module_id)
+            # The state call does not depend on the action list, so
+            # issue both at once on a cold first poll
+            _, resp = await asyncio.gather(
+                self._cache_soap_actions(),
+                self.client.call("GetWaterDetectorState", ModuleID=self.module_id),
+            )
+        else:
+            resp = await self.client.call(
+                "GetWaterDetectorState", ModuleID=self.module_id
+            )
         return resp.get("IsWater") == "true"
 
 
@@ -222,10 +305,45 @@ class NanoSOAPClient:
         self.address = "http://{0}/HNAP1".format(address)
         self.action = action
         self.loop = loop or asyncio.get_event_loop()
-        self.session = session or aiohttp.ClientSession(loop=loop)
+        # Keep-alive longer than the poll interval so the same TCP
+        # connection is reused between polls
+        self.session = session or aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit_per_host=1, keepalive_timeout=30, loop=loop
+            ),
+            loop=loop,
+        )
         self.headers = {}
+        self._tmpl_cache = {}
+        self._action_headers = {}
+
+    def _build_request_template(self, method, params):
+        """Build a request template for a method and its parameter names."""
+        namespaces = " ".join(
+            '{0}="{1}"'.format(name, value) for name, value in self.BASE_NS.items()
+        )
+        values = "".join(
+            "<{0}>{{{1}}}</{0}>".format(param, index)
+            for index, param in enumerate(params)
+        )
+        return (
+            "<?xml version='1.0' encoding='utf-8'?>"
+            "<soap:Envelope {0}><soap:Body>"
+            '<{1} xmlns="{2}">{3}</{1}>'
+            "</soap:Body></soap:Envelope>"
+        ).format(namespaces, method, self.ACTION_NS["xmlns"], values)
 
     def _generate_request_xml(self, method, **kwargs):
+        params = tuple(kwargs)
+        if method.isidentifier() and all(param.isidentifier() for param in params):
+            template = self._tmpl_cache.get((method, params))
+            if template is None:
+                template = self._build_request_template(method, params)
+                self._tmpl_cache[(method, params)] = template
+            values = [escape(str(value)) for value in kwargs.values()]
+            return template.format(*values).encode("utf-8")
+
+        # Unusual method or parameter names: build the tree the slow way
         body = ET.Element("soap:Body")
         action = ET.Element(method, self.ACTION_NS)
         body.append(action)
@@ -238,28 +356,50 @@ class NanoSOAPClient:
         envelope = ET.Element("soap:Envelope", self.BASE_NS)
         envelope.append(body)
 
-        f = BytesIO()
-        tree = ET.ElementTree(envelope)
-        tree.write(f, encoding="utf-8", xml_declaration=True)
+        return ET.tostring(envelope, encoding="utf-8")
 
-        return f.getvalue().decode("utf-8")
+    @staticmethod
+    def _extract_value(content, tag):
+        """Pull the first value of a tag, stopping as soon as it is seen."""
+        for _, element in ET.iterparse(BytesIO(content), events=("end",)):
+            if element.tag.rpartition("}")[2] == tag:
+                return element.text
+        return None
 
-    async def call(self, method, **kwargs):
+    async def call(self, method, extract=None, **kwargs):
         xml = self._generate_request_xml(method, **kwargs)
 
+        soap_action = self._action_headers.get(method)
+        if soap_action is None:
+            soap_action = '"{0}{1}"'.format(self.action, method)
+            self._action_headers[method] = soap_action
+
         headers = self.headers.copy()
-        headers["SOAPAction"] = '"{0}{1}"'.format(self.action, method)
+        headers["SOAPAction"] = soap_action
+        headers["Content-Type"] = "text/xml; charset=utf-8"
 
-        resp = await self.session.post(
-            self.address, data=xml, headers=headers, timeout=10
-        )
-        text = await resp.text()
-        parsed = xmltodict.parse(text)
-        if "soap:Envelope" not in parsed:
-            _LOGGER.error("parsed: " + str(parsed))
+        resp = await self.session.post(self.address, data=xml, headers=headers)
+        content = await resp.read()
+
+        if extract is not None:
+            value = self._extract_value(content, extract)
+            if value is not None:
+                return value
+            # Fall through so the unexpected payload gets reported
+
+        parsed = ET.fromstring(content)
+
+        response = None
+        for element in parsed.iter():
+            if element.tag.rpartition("}")[2] == method + "Response":
+                response = element
+                break
+
+        if response is None:
+            _LOGGER.error("parsed: %s", content)
             raise Exception("probably a bad response")
 
-        return parsed["soap:Envelope"]["soap:Body"][method + "Response"]
+        return _element_to_dict(response)
 
 
 if __name__ == "__main__":
@@ -273,14 +413,13 @@ if __name__ == "__main__":
     cmd = sys.argv[3]
 
     async def _print_latest_motion():
-        session = aiohttp.ClientSession()
-        soap = NanoSOAPClient(address, ACTION_BASE_URL, loop=loop, session=session)
+        soap = NanoSOAPClient(address, ACTION_BASE_URL, loop=loop)
         client = HNAPClient(soap, "Admin", pin, loop=loop)
         await client.login()
 
         if cmd == "latest_motion":
             latest = await BaseSensor(client).latest_trigger()
-            print("Latest time: " + str(latest))
+            print("Latest time: " + str(datetime.fromtimestamp(latest)))
         elif cmd == "water_detected":
             latest = await WaterSensor(client).water_detected()
             print("Water detected: " + str(latest))
@@ -293,6 +432,6 @@ if __name__ == "__main__":
             )
             print(resp)
 
-        session.close()
+        await soap.session.close()
 
     loop.run_until_complete(_print_latest_motion())